@@ -33,6 +33,22 @@ cd "$TBB_PATH/Browser"
 
 # Generate some data by downloading many webpages over meek 
 xvfb-run -a python3 -u "${SRC_DIR}/main.py" "${CONFIG_PATH}" "${TBB_PATH}" &
+xvfb_pid=$!
 
-# Wait for the python script to finish (or be interrupted)
-wait $!
+# This script is PID 1, so docker stop's SIGTERM lands here and would be
+# ignored. xvfb-run doesn't pass signals on either, so send it straight to
+# the python script, which hands back its work and shuts down cleanly.
+# xvfb-run then cleans up Xvfb and exits with the script's status
+forward_signal() {
+    pkill -TERM -P "${xvfb_pid}" -f "^python3 -u ${SRC_DIR}/main.py" || true
+}
+trap forward_signal TERM INT
+
+# Wait for the python script to finish (or be interrupted). wait returns
+# early whenever a trapped signal arrives, so keep waiting until it exits
+while true; do
+    status=0
+    wait "${xvfb_pid}" || status=$?
+    kill -0 "${xvfb_pid}" 2>/dev/null || break
+done
+exit "${status}"
@@ -16,6 +16,7 @@
 # along with packet_captor_sakura.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import signal
 from pathlib import Path
 
 import toml
@@ -26,6 +27,14 @@ from utils import build_logger
 from worker import Worker
 
 
+def handle_sigterm(signum, frame):
+    """
+    Turns SIGTERM (sent by docker stop) into an exception, so the worker
+    cleans up and returns its prefetched work
+    """
+    raise SystemExit(128 + signum)
+
+
 def main(args):
     # Read in the config
     config = None
@@ -37,6 +46,9 @@ def main(args):
 
     logger.info("Starting the worker")
 
+    # Make sure the worker's cleanup runs when the container is stopped
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     # Start up a worker
     with Worker("url_queue", 3000, config, tbb_path=args.tbb_path) as worker:
         # Request work until there is no more
@@ -24,7 +24,7 @@ from stem import process as stem_process
 class Proxy():
     def __init__(self, tbb_path, tor_config: dict):
         # Get the logger
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         # ==============================
         # Initialize tor stuff
         # ==============================
@@ -38,9 +38,16 @@ class Proxy():
         meek_client_tb_path = tor_path / "PluggableTransports" / "meek-client-torbrowser"
         # Obfsproxy path
         obfsproxy_path = tor_path / "PluggableTransports" / "obfs4proxy"
+        # Persistent data directory so cached consensus and descriptors
+        # survive between launches
+        self.data_dir = Path(tor_config.get("data_dir", "/tmp/tor-cache"))
+        self.data_dir.mkdir(parents=True, exist_ok=True)
         # Set the bridge
         # Build the config
         self.tor_config = {
+            "DataDirectory": str(self.data_dir),
+            "ClientOnly": "1",
+            "AvoidDiskWrites": "0",
             "UseBridges": "1",
             "ClientTransportPlugin":
             "meek_lite exec {}".format(obfsproxy_path.absolute()),
@@ -58,70 +65,89 @@ class Proxy():
             os.environ["LD_LIBRARY_PATH"] = str(tor_path)
         # No tor process on construction
         self.tor_process = None
-        # Whether tor has not already been started once
+        # Whether tor has not already been started once. Later launches
+        # reuse the data directory, so they get the shorter timeout
         self.first_tor_run = True
 
         # Store the timeouts
         self.tor_timeouts = tor_config["timeout"]
 
-        # Initially, there is no mod
-        self.mode = None
+    def start(self):
+        """
+        Starts the tor process, which is kept running until stop is called
+        """
+        self.logger.info("Starting the proxy")
+        if self.tor_process is not None:
+            self.logger.warning("TOR is already running")
+            return self
+        # Calculate the timeout based on which run
+        # If the first run flag is set, unset it
+        timeout = None
+        if self.first_tor_run:
+            timeout = self.tor_timeouts["initial"]
+            self.first_tor_run = False
+        else:
+            timeout = self.tor_timeouts["regular"]
+        self.logger.info("Starting TOR")
+        # Launch the tor process
+        self.tor_process = stem_process.launch_tor_with_config(
+            config=self.tor_config,
+            tor_cmd=str(self.tor_executable_path),
+            timeout=timeout,
+            take_ownership=True,
+            # init_msg_handler = print
+        )
+        self.logger.info("Started the proxy")
+        # Return nothing
+        return self
 
-    def start(self, mode: str):
+    def needs_launch(self, mode: str) -> bool:
+        """
+        Whether set_mode will have to launch tor for the given mode
+        :param mode: mode of the next work item
         """
-        Starts tor if the given mode is tor
+        return mode == "tor" and (self.tor_process is None
+                                  or self.tor_process.poll() is not None)
+
+    def set_mode(self, mode: str):
+        """
+        Prepares tor for a work item of the given mode. In tor mode, tor is
+        started if it is not running or has exited, and an already running
+        process is reused. In normal mode, tor is stopped so none of its
+        traffic ends up in the capture
+        :param mode: mode of the next work item
         """
-        self.logger.info("Starting the proxy in %s mode", mode)
-        # Store the mode
-        self.mode = mode
-        # Start tor
         if mode == "tor":
-            # Calculate the timeout based on which run
-            # If the first run flag is set, unset it
-            timeout = None
-            if self.first_tor_run:
-                timeout = self.tor_timeouts["initial"]
-                self.first_tor_run = False
-            else:
-                timeout = self.tor_timeouts["regular"]
-            self.logger.info("Starting TOR")
-            # Launch the tor process
-            self.tor_process = stem_process.launch_tor_with_config(
-                config=self.tor_config,
-                tor_cmd=str(self.tor_executable_path),
-                timeout=timeout,
-                take_ownership=True,
-                # init_msg_handler = print
-            )
+            if self.tor_process is not None:
+                if self.tor_process.poll() is None:
+                    return self
+                self.logger.warning("TOR exited with code %s, restarting",
+                                    self.tor_process.returncode)
+                self.tor_process = None
+            return self.start()
         elif mode == "normal":
-            self.logger.info("Starting null proxy")
+            if self.tor_process is not None:
+                self.stop()
+            return self
         else:
             raise Exception(f"Invalid mode: {mode}")
-        self.logger.info("Started the proxy")
-        # Return nothing
-        return self
 
     def stop(self):
-
+        """
+        Stops the tor process
+        """
         self.logger.info("Stopping the proxy")
 
-        if self.mode == "tor":
-            if self.tor_process is None:
-                self.logger.warning(
-                    "Cannot kill tor process that does not exist")
-            else:
-                # Kill tor
-                self.logger.info("Stopping TOR")
-                self.tor_process.terminate()
-                self.tor_process.wait()
-                self.logger.info("Stopped TOR")
-
-                # Clear the process variable
-                self.tor_process = None
-        elif self.mode == "normal":
-            self.logger.info("Stopping null proxy")
+        if self.tor_process is None:
+            self.logger.warning("Cannot kill tor process that does not exist")
+        else:
+            # Kill tor
+            self.logger.info("Stopping TOR")
+            self.tor_process.terminate()
+            self.tor_process.wait()
+            self.logger.info("Stopped TOR")
 
-        # Clear the mode
-        self.mode = None
+            # Clear the process variable
+            self.tor_process = None
 
         self.logger.info("Stopped the proxy")
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with packet_captor_sakura.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import os
+import tempfile
 import traceback
 from base64 import b64encode
 
@@ -34,7 +36,7 @@ class Requester():
         @param config the configuration to load options from
         """
         # Get the logger
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         # Set up firefox to run in headless mode to avoid graphical overhead
         options = FirefoxOptions()
         options.set_headless(True)
@@ -45,15 +47,34 @@ class Requester():
         self.wait_tag = firefox_config["wait_tag"]
         self.load_images = int(firefox_config["load_images"])
         self.clean_frequency = int(firefox_config["clean_frequency"])
+        self.reuse_browser = bool(firefox_config.get("reuse_browser", False))
         self.page_timeout = int(firefox_config["timeout"]["page"])
         self.element_timeout = int(firefox_config["timeout"]["element"])
+        # Conditions used to detect that a page has loaded
+        self._wait_cond = EC.presence_of_element_located((By.TAG_NAME,
+                                                          self.wait_tag))
+        self._cleanup_cond = EC.presence_of_element_located((By.TAG_NAME,
+                                                             "p"))
         # Store tor proxy config
         self.tor_port = tor_port
+        # Keep profiles on a tmpfs. Selenium copies the profile into the
+        # temporary directory, and geckodriver (a child process) unpacks it
+        # into its own, so this changes the temporary directory for the
+        # whole process. tempfile caches its directory on first use, so it
+        # is set directly as well as through TMPDIR. Profiles left behind by
+        # crashed runs stay in profile_dir, which is shared with the host
+        # when it is /dev/shm
+        profile_dir = firefox_config.get("profile_dir", "/dev/shm")
+        if os.path.isdir(profile_dir):
+            os.environ["TMPDIR"] = profile_dir
+            tempfile.tempdir = profile_dir
         # Set driver to None for now
         self.driver = None
         # Initialize some members that will be stored later
-        self.mode = None
+        self.current_mode = None
         self.profile = None
+        # Number of requests made with the current driver
+        self.request_count = 0
 
     def start(self, mode: str):
         """
@@ -63,7 +84,7 @@ class Requester():
         """
         self.logger.info("Starting browser with mode %s", mode)
         # Store the mode
-        self.mode = mode
+        self.current_mode = mode
         # Configure profile settings
         profile = FirefoxProfile()
         # Disable CSS since it doesn't make extra requests, and disabling it speeds us up
@@ -76,6 +97,20 @@ class Requester():
         profile.set_preference("browser.cache.memory.enable", False)
         profile.set_preference("browser.cache.offline.enable", False)
         profile.set_preference("network.http.use-cache", False)
+        # Disable background requests that would end up in the capture
+        profile.set_preference("browser.shell.checkDefaultBrowser", False)
+        profile.set_preference("toolkit.telemetry.enabled", False)
+        profile.set_preference("datareporting.healthreport.uploadEnabled",
+                               False)
+        # A reused browser would carry idle connections and TLS sessions
+        # into the next capture. Close idle HTTP/1 and HTTP/2 connections
+        # quickly and don't resume TLS sessions, so each capture starts with
+        # fresh connections and full handshakes
+        if self.reuse_browser:
+            profile.set_preference("network.http.keep-alive.timeout", 1)
+            profile.set_preference("network.http.spdy.timeout", 1)
+            profile.set_preference("security.ssl.disable_session_identifiers",
+                                   True)
         # Set proxy based on mode
         if mode == "tor":
             profile.set_preference("network.proxy.type", 1)
@@ -87,11 +122,14 @@ class Requester():
         # Store profile
         self.profile = profile
         # Store the new mode
-        self.mode = mode
+        self.current_mode = mode
+        self.request_count = 0
         self.logger.info("Starting the webdriver")
         # Build a Firefox webdriver
         self.driver = webdriver.Firefox(
-            self.profile, firefox_options=self.options)
+            self.profile,
+            firefox_options=self.options,
+            service_log_path=os.devnull)
         # Set timeouts
         self.driver.set_page_load_timeout(self.page_timeout // 5)
         # self.driver.implicitly_wait(self.page_timeout)
@@ -105,11 +143,75 @@ class Requester():
 
         # Nullify the reference
         self.driver = None
-        self.mode = None
+        self.current_mode = None
         self.profile = None
 
         self.logger.info("Stopped the webdriver")
 
+    def alive(self) -> bool:
+        """
+        Checks whether the browser behind the webdriver still responds
+
+        @return whether the webdriver can still be used
+        """
+        if self.driver is None:
+            return False
+        try:
+            # Any command will do, this one is cheap
+            self.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def discard(self):
+        """
+        Drops a webdriver whose browser died, so the next request gets a
+        fresh one. quit is still attempted to reap geckodriver, but its
+        failure is expected and ignored.
+        """
+        self.logger.warning("Discarding dead webdriver")
+        try:
+            self.driver.quit()
+        except Exception as exc:
+            self.logger.debug("Failed to quit dead webdriver: %s", exc)
+        # Nullify the reference
+        self.driver = None
+        self.current_mode = None
+        self.profile = None
+
+    def retire(self, mode: str):
+        """
+        Stops the webdriver if it can't be reused for the given mode, which
+        is always the case unless reuse_browser is set, and otherwise if the
+        mode changed or it has served clean_frequency requests. This is
+        separate from ensure_started so the old browser can be shut down
+        before the next capture starts.
+
+        @param mode the mode of the next request
+        """
+        if self.driver is None:
+            return
+        if not self.reuse_browser:
+            self.stop()
+        elif mode != self.current_mode:
+            self.logger.info("Mode changed from %s to %s", self.current_mode,
+                             mode)
+            self.stop()
+        elif self.request_count >= self.clean_frequency:
+            self.logger.info("Recycling webdriver after %d requests",
+                             self.request_count)
+            self.stop()
+
+    def ensure_started(self, mode: str):
+        """
+        Starts a webdriver in the given mode unless one is already running.
+        Call retire first to get rid of a driver that can't be reused.
+
+        @param mode the mode the webdriver should be running in
+        """
+        if self.driver is None:
+            self.start(mode)
+
     def request(self, url: str) -> bool:
         """
         Makes a request using the webdriver
@@ -117,57 +219,69 @@ class Requester():
         @param driver the webdriver to use
         @param url the url to request
         @return whether the request succeeded
+        @raises Exception if the browser died and couldn't be replaced
         """
-        for retry in range(1, self.retries):
+        self.request_count += 1
+        for retry in range(self.retries):
             try:
-                # Request the page
-                self.driver.get(url)
-                # Log the title of whatever loaded
-                self.logger.debug("Title of loaded page: %s",
-                                  self.driver.title)
+                # Request the page. The page load timeout is kept short, and
+                # a page that is still loading is detected by waiting for a
+                # specific tag instead
+                loaded = True
+                try:
+                    self.driver.get(url)
+                except TimeoutException:
+                    loaded = False
+                if not loaded:
+                    self.logger.debug("Waiting to find a %s tag",
+                                      self.wait_tag)
+                    WebDriverWait(
+                        self.driver, self.element_timeout,
+                        poll_frequency=0.2).until(self._wait_cond)
+                # Log the title of whatever loaded. Fetching the title is a
+                # round trip to the browser, so skip it if it won't be logged
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Title of loaded page: %s",
+                                      self.driver.title)
                 # Break out of the retry loop
                 break
+            # The tag never showed up, just ignore it
+            except TimeoutException:
+                self.logger.warning("Timeout loading %s", url)
+                break
             # Ignore broken pipe and try again
             except BrokenPipeError as _:
                 self.logger.error(
                     "Geckodriver had a broken pipe error. Retrying request (%d/%d)",
                     retry + 1, self.retries)
                 continue
-            # Page will probably time out. If it does, just wait for
-            # a specific tag
-            except TimeoutException:
-                try:
-                    self.logger.debug("Waiting to find a %s tag",
-                                      self.wait_tag)
-
-                    WebDriverWait(self.driver, self.element_timeout).until(
-                        EC.presence_of_element_located((By.TAG_NAME,
-                                                        self.wait_tag)))
-
-                    self.logger.info("Title of loaded page: %s",
-                                     self.driver.title)
-                # If we get a timeout exception here, just ignore it
-                except TimeoutException:
-                    self.logger.warning("Timeout loading %s", url)
-                except Exception as exc:
-                    self.logger.error(str(exc))
-                # Break the loop
-                break
             # If the session died, recreate it
             except SessionNotCreatedException:
                 # Restart the web driver
-                self.stop()
-                self.start(self.mode)
+                mode = self.current_mode
+                self.discard()
+                self.start(mode)
                 # Do another retry
                 continue
-            # Just ignore other exceptions
+            # Other exceptions are either an error page or a dead browser
             except Exception as exc:
-                # Log the error
-                trace = b64encode(traceback.format_exc().encode('utf-8'))
-                self.logger.error("Failure in making request: %s, %s", exc,
-                                  trace)
-                # Break the loop
-                break
+                # Log the error, only formatting the trace if it is emitted
+                if self.logger.isEnabledFor(logging.ERROR):
+                    trace = b64encode(traceback.format_exc().encode('utf-8'))
+                    self.logger.error("Failure in making request: %s, %s",
+                                      exc, trace)
+                # A live browser just failed to load the page, ignore it
+                if self.alive():
+                    break
+                # Otherwise replace the browser and try again. If this was
+                # the last try, fail the request so the work gets requeued
+                # instead of being reported with an empty capture
+                mode = self.current_mode
+                self.discard()
+                if retry + 1 >= self.retries:
+                    raise
+                self.start(mode)
+                continue
         # Clean the driver
         self.cleanup()
 
@@ -180,9 +294,14 @@ class Requester():
             # Go to blank page to stop loading
             self.driver.get("about:mozilla")
             # Because our get timeout is normally low, use an explicit wait
-            WebDriverWait(self.driver, self.element_timeout).until(
-                EC.presence_of_element_located((By.TAG_NAME, "p")))
+            WebDriverWait(self.driver,
+                          self.element_timeout).until(self._cleanup_cond)
         # We don't handle SessionNotCreatedException here
         except Exception as exc:
-            self.logger.error("Failed to cleanup: %s %s", exc,
-                              traceback.format_exc())
+            if self.logger.isEnabledFor(logging.ERROR):
+                self.logger.error("Failed to cleanup: %s %s", exc,
+                                  traceback.format_exc())
+            # Don't let the next request use a dead browser.
+            # ensure_started will replace it
+            if not self.alive():
+                self.discard()
@@ -15,9 +15,59 @@
 # You should have received a copy of the GNU General Public License
 # along with packet_captor_sakura.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
+import json
+import os
+import tempfile
 from pathlib import Path
 
-import toml
+# Prefer the stdlib parser (Python 3.11+), then tomli, then toml
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+        import toml
+
+
+def load_toml(config_filename: Path) -> dict:
+    """
+    Parses the TOML config file
+    :param config_filename: path to the config file
+    """
+    if tomllib is not None:
+        with config_filename.open("rb") as config_file:
+            return tomllib.load(config_file)
+    with config_filename.open("r") as config_file:
+        return toml.load(config_file)
+
+
+def write_cache(cache_filename: Path, config: dict):
+    """
+    Writes the parsed config to the cache. The cache is written to a
+    temporary file and moved into place, so concurrent readers never see a
+    partial file. Failures such as a read-only directory or values (like
+    dates) that JSON can't represent are ignored
+    :param cache_filename: path to the cache file
+    :param config: parsed config
+    """
+    try:
+        cache = json.dumps(config)
+        fd, temp_filename = tempfile.mkstemp(
+            dir=str(cache_filename.parent), prefix=cache_filename.name)
+        try:
+            with os.fdopen(fd, "w") as temp_file:
+                temp_file.write(cache)
+            # mkstemp creates the file readable only by its owner
+            os.chmod(temp_filename, 0o644)
+            os.replace(temp_filename, str(cache_filename))
+        except OSError:
+            os.unlink(temp_filename)
+            raise
+    except (OSError, TypeError):
+        pass
+
 
 # Parses arguments
 arg_parser = argparse.ArgumentParser(
@@ -37,10 +87,22 @@ arg_parser.add_argument(
 # Parse the arguments
 args = arg_parser.parse_args()
 
-# Read in the config file
+# Parsed config is cached next to the config file as JSON, which is much faster
+# to load than TOML when this is called repeatedly from shell scripts
+cache_filename = args.config_filename.with_name(args.config_filename.name +
+                                                ".cache.json")
+# Read in the config file, using the cache if it is at least as new
 config = None
-with args.config_filename.open("r") as config_file:
-    config = toml.load(config_file)
+try:
+    if (cache_filename.stat().st_mtime >=
+            args.config_filename.stat().st_mtime):
+        with cache_filename.open("r") as cache_file:
+            config = json.load(cache_file)
+except (OSError, ValueError):
+    config = None
+if config is None:
+    config = load_toml(args.config_filename)
+    write_cache(cache_filename, config)
 # Convert the option into a series of keys and traverse the configuration
 result = config
 for key in args.option.split("."):
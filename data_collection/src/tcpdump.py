@@ -15,11 +15,19 @@
 # along with packet_captor_sakura.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import selectors
 import socket
 import struct
 import typing
 from pathlib import Path
 
+# Header of the start request: command code and filename length
+_HDR = struct.Struct("<BI")
+# Seconds to wait for the socket to become ready before logging and retrying
+_IO_TIMEOUT = 5
+# Number of waits before giving up on the controller
+_IO_RETRIES = 12
+
 
 class TcpDump():
     """
@@ -33,47 +41,114 @@ class TcpDump():
                                 the daemon
         """
         # Get the logger
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         # Connect to the tcpdump service socket
         self.tcpdump = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.tcpdump.connect(socket_filename)
-        self.tcpdump.settimeout(60)
+        # Use a non-blocking socket and wait on it with a selector, so a hung
+        # controller shows up in the logs instead of blocking silently
+        self.tcpdump.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.tcpdump, selectors.EVENT_READ)
+        # Whether a capture is currently running
+        self.capturing = False
 
-    def start(self, filename: str):
+    @staticmethod
+    def _start_message(filename: str) -> bytes:
         """
-        Starts tcpdump
-        :param url: filename for the pcap file
+        Builds the request that starts tcpdump
+        :param filename: filename for the pcap file
         """
         # Create the filename
         # TODO: only pass filename and have tcpdump controller handle the path prefix
         filename = Path("/pcap_data") / filename
         # Get filename as bytes
         filename = str(filename).encode('utf-8')
+        return _HDR.pack(0x00, len(filename)) + filename
 
-        self.logger.info("Starting tcpdump")
+    def _wait(self, events: int):
+        """
+        Waits until the socket is ready for the given events
+        :param events: selector events to wait for
+        :throws TcpDumpError: if the socket does not become ready in time
+        """
+        self.selector.modify(self.tcpdump, events)
+        for attempt in range(_IO_RETRIES):
+            if self.selector.select(_IO_TIMEOUT):
+                return
+            self.logger.warning(
+                "Still waiting on tcpdump controller (%d/%d)", attempt + 1,
+                _IO_RETRIES)
+        raise TcpDumpError("Timed out waiting on tcpdump controller")
 
-        # Send request over socket
-        msg = struct.pack("<BI", 0x00, len(filename)) + filename
-        self.tcpdump.send(msg)
+    def _send(self, *buffers: bytes):
+        """
+        Sends the given buffers to the controller
+        :param buffers: buffers to send, in order
+        """
+        while True:
+            try:
+                sent = self.tcpdump.sendmsg(buffers)
+                break
+            except BlockingIOError:
+                self._wait(selectors.EVENT_WRITE)
+        # Send whatever did not fit in the socket buffer
+        remaining = b''.join(buffers)[sent:]
+        while remaining:
+            try:
+                remaining = remaining[self.tcpdump.send(remaining):]
+            except BlockingIOError:
+                self._wait(selectors.EVENT_WRITE)
 
-        # Handle response over socket
-        response = self.tcpdump.recv(1)[0]
+    def _recv_responses(self, count: int) -> bytes:
+        """
+        Reads the given number of response codes from the controller, or
+        fewer if the controller closes the connection
+        :param count: number of response codes to read
+        """
+        responses = b''
+        while len(responses) < count:
+            try:
+                chunk = self.tcpdump.recv(count - len(responses))
+            except BlockingIOError:
+                self._wait(selectors.EVENT_READ)
+                continue
+            if not chunk:
+                break
+            responses += chunk
+        return responses
+
+    def _recv_response(self) -> int:
+        """
+        Reads a single response code from the controller
+        """
+        response = self._recv_responses(1)
+        if not response:
+            raise TcpDumpError("Received no response from tcpdump controller")
+        return response[0]
+
+    def _check_start_response(self, response: int):
+        """
+        Handles the controller's response to a start request
+        :param response: response code from the controller
+        :throws TcpDumpError: if tcpdump did not start
+        """
         if response == 0x00:
+            self.capturing = True
             self.logger.info("Successfully started tcpdump")
         elif response == 0x01:
             raise TcpDumpError("Failed to start tcpdump")
         else:
             raise TcpDumpError("Invalid response from starting tcpdump")
 
-    def stop(self):
+    def _check_stop_response(self, response: int):
         """
-        Stops tcpdump
+        Handles the controller's response to a stop request
+        :param response: response code from the controller
+        :throws TcpDumpError: if tcpdump did not stop
         """
-        # Send request over socket
-        self.tcpdump.send(b'\x01')
-        # Handle response over socket
-        response = self.tcpdump.recv(1)[0]
         if response == 0x00:
+            self.capturing = False
             self.logger.info("Successfully stopped tcpdump")
         elif response == 0x01:
             raise TcpDumpError("failed to stop tcpdump")
@@ -81,15 +156,59 @@ class TcpDump():
             raise TcpDumpError(
                 "Received invalid response code from tcpdump controller")
 
+    def start(self, filename: str):
+        """
+        Starts tcpdump
+        :param url: filename for the pcap file
+        """
+        self.logger.info("Starting tcpdump")
+
+        # Send request over socket
+        msg = self._start_message(filename)
+        self._send(msg)
+
+        # Handle response over socket
+        self._check_start_response(self._recv_response())
+
+    def rotate(self, filename: str):
+        """
+        Stops the running tcpdump and starts a new one, sending both
+        requests in a single call and reading both responses together
+        :param filename: filename for the new pcap file
+        """
+        self.logger.info("Rotating tcpdump")
+
+        # Send both requests over socket
+        self._send(b'\x01', self._start_message(filename))
+
+        # Handle both responses over socket
+        responses = self._recv_responses(2)
+        if not responses:
+            raise TcpDumpError("Received no response from tcpdump controller")
+        self._check_stop_response(responses[0])
+        if len(responses) < 2:
+            raise TcpDumpError("Received no response from starting tcpdump")
+        self._check_start_response(responses[1])
+
+    def stop(self):
+        """
+        Stops tcpdump
+        """
+        # Send request over socket
+        self._send(b'\x01')
+        # Handle response over socket
+        self._check_stop_response(self._recv_response())
+
     def shutdown(self):
         """
         Shuts down the tcpdump controller
         """
         # Send request over socket
-        self.tcpdump.send(b'\x02')
+        self._send(b'\x02')
         # Handle response over socket
-        response = self.tcpdump.recv(1)[0]
+        response = self._recv_response()
         if response == 0x00:
+            self.capturing = False
             self.logger.info("Successfully shutdown tcpdump")
         elif response == 0x01:
             raise TcpDumpError("Failed to shutdown tcpdump")
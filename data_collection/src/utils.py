@@ -24,6 +24,10 @@ def build_logger(config):
     """
     # Extract config parameters
     log_level = config["log_level"].upper()
+    # The formatter doesn't use thread or process info, so skip collecting it
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     # Set up a logger
     logger = logging.getLogger()
     # Convert the log level to an enum
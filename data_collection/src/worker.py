@@ -14,17 +14,35 @@
 # You should have received a copy of the GNU General Public License
 # along with packet_captor_sakura.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import logging
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from proxy import Proxy
 from requester import Requester
 from tcpdump import TcpDump, TcpDumpError
 
+# time.time_ns was added in Python 3.7, and the capture image ships 3.6
+try:
+    from time import time_ns
+except ImportError:
+
+    def time_ns() -> int:
+        return int(time.time() * 1e9)
+
+
+# Number of times to try contacting the work queue on startup
+_MAX_CONTACT_ATTEMPTS = 120
+# Headers for request bodies that are serialized ahead of time
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
 
 class Worker():
     def __init__(self, host: str, port: int, config: dict, tbb_path):
@@ -33,22 +51,33 @@ class Worker():
         """
         # Create the work url
         self.work_url = "http://{}:{}".format(host, port)
+        # Build the endpoint URLs once
+        self._status_url = f"{self.work_url}/status"
+        self._client_add_url = f"{self.work_url}/client/add"
+        self._client_remove_url = f"{self.work_url}/client/remove"
+        self._work_get_url = f"{self.work_url}/work/get"
+        self._work_report_url = f"{self.work_url}/work/report"
         # Store number of times work is completed per type
         self.work_type_counts = {'normal': 0, 'tor': 0}
         # Create a requests session
         self.session = requests.Session()
-        # Disable keepalive
-        self.session.keep_alive = False
         # Get a logger
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         # Store given config
         self.config = config
         self.tbb_path = tbb_path
         # Initialize members that will be created later
         self.client_id = None
+        # Serialized {'client_id': ...} body, built once the ID is known
+        self._client_id_body = None
         self.tcpdump = None
         self.proxy = None
         self.requester = None
+        # Background thread used for work queue requests, so they overlap
+        # with browsing
+        self._executor = None
+        # Pending request for the next piece of work
+        self._next_work = None
 
     def __enter__(self):
         """
@@ -57,29 +86,46 @@ class Worker():
         Gets a connection to the tcpdump daemon
         :throws Exception: if the client ID request fails
         """
+        # Use a single pooled adapter so the connection to the work queue is
+        # kept alive across requests instead of reconnecting every time
+        self.session.mount(
+            "http://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=4,
+                max_retries=Retry(total=3, backoff_factor=0.1)))
+        self.session.headers.update({"Connection": "keep-alive"})
         # Send requests to the URLs service until the status
-        # page returns a response
-        waiting = True
-        while waiting:
+        # page returns a response. The pooled connection that succeeds here
+        # is reused to register the client
+        for attempt in range(_MAX_CONTACT_ATTEMPTS):
             try:
                 self.logger.info("Attempting to contact work queue")
-                self.session.get("{}/status".format(self.work_url))
-                waiting = False
+                self.session.request('GET', self._status_url)
+                break
             except Exception as _:
                 self.logger.info(
                     "Attempt to contact work queue failed. Retrying")
+                # Back off exponentially, up to a second between attempts
+                time.sleep(min(2**attempt * 0.05, 1.0))
+        else:
+            raise Exception("Failed to contact work queue after {} attempts".
+                            format(_MAX_CONTACT_ATTEMPTS))
         # Request a client ID
         # TODO: look into renaming this "register"
         self.logger.info("Registering client with server")
         # TODO: work types as part of config
         response = self.session.post(
-            "{}/client/add".format(self.work_url),
+            self._client_add_url,
             json={'work_types': ['tor', 'normal']})
         # Parse response as json
         response = response.json()
         # Extract client id from response
         if response['success']:
             self.client_id = response['client_id']
+            self._client_id_body = json.dumps({
+                'client_id': self.client_id
+            }).encode('utf-8')
         else:
             raise Exception(response['error'])
         # Start up a connection to the tcpdump daemon
@@ -90,6 +136,8 @@ class Worker():
         # Instantiate requester object
         self.requester = Requester(self.config["firefox"],
                                    self.config["tor"]["port"])
+        # A single thread keeps work queue requests in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -105,24 +153,88 @@ class Worker():
         else:
             # Log the error
             self.logger.error("%s %s %s", exc_type, exc_value, traceback)
-        # Indicate to the server that the client has stopped
-        self.logger.info("Deregistering client from server")
-        self.session.post(
-            "{}/client/remove".format(self.work_url),
-            json={'client_id': self.client_id})
-        # Stop the tcpdump daemon
-        self.tcpdump.shutdown()
+        # Return prefetched work first, since the queue has no other way
+        # to get it back
+        try:
+            self._return_prefetched_work()
+        except Exception as exc:
+            self.logger.error("Failed to return prefetched work: %s", exc)
+        # The controller has to be shut down even if deregistering or stopping
+        # the browser or tor fails, otherwise the last capture is left open
+        try:
+            # Wait for queued reports to be sent
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            # Indicate to the server that the client has stopped
+            self.logger.info("Deregistering client from server")
+            self.session.post(
+                self._client_remove_url,
+                data=self._client_id_body,
+                headers=_JSON_HEADERS)
+            # FIXME: Make a dummy request to the server. to enforce the
+            # shutdown. The server only checks its shutdown flag when it
+            # handles a request, so this is only needed once the client has
+            # been removed
+            # Allow this to fail
+            try:
+                self.session.post(self._status_url)
+            except:
+                pass
+            # Stop the requester
+            if (self.requester is not None
+                    and self.requester.driver is not None):
+                self.requester.stop()
+            # Stop the proxy
+            if self.proxy is not None and self.proxy.tor_process is not None:
+                self.proxy.stop()
+        finally:
+            # Stop the tcpdump daemon
+            self.tcpdump.shutdown()
+
+    def _return_prefetched_work(self):
+        """
+        Reports prefetched work that will not be performed as failed, so the
+        server puts it back in the queue
+        """
+        if self._next_work is None:
+            return
+        work = self._next_work.result()
+        self._next_work = None
+        if work is not None:
+            self.logger.info("Returning unperformed work to server")
+            self.send_report({
+                'success': False,
+                'work_type': work["work_type"],
+                'work': work["work"],
+                'type_index': 0,
+                'start_time': 0,
+                'finish_time': 0,
+            })
 
     def request_work(self):
         """
-        Requests a piece of work from the server
+        Requests a piece of work from the server, using the work prefetched
+        by perform_work if there is any
+        """
+        if self._next_work is not None:
+            # Only clear the prefetch once it has been received, so that
+            # __exit__ can still return it if the wait is interrupted
+            work = self._next_work.result()
+            self._next_work = None
+            return work
+        return self._request_work_raw()
+
+    def _request_work_raw(self):
+        """
+        Makes a request for a piece of work to the server
         """
         # Make a request to the server to get a URL to navigate to
         try:
             # Make a request for work
             response = self.session.post(
-                "{}/work/get".format(self.work_url),
-                json={'client_id': self.client_id})
+                self._work_get_url,
+                data=self._client_id_body,
+                headers=_JSON_HEADERS)
             # 204 means no more URLs
             if response.status_code == 204:
                 self.logger.info("No more URLs")
@@ -148,40 +260,50 @@ class Worker():
         global_index = work["index"]
         # Set work type counter
         self.work_type_counts[mode] += 1
+        # Fetch the next piece of work while this one is performed
+        self._next_work = self._executor.submit(self._request_work_raw)
         # Scoped variables set inside try block
         error = None
         fatal = False
         # Store timestamp
-        start_time = int(time.time() * 1e9)
+        start_time = time_ns()
         try:
-            # Start packet capture
-            self.tcpdump.start(filename)
-            # Start proxy
-            self.proxy.start(mode)
-            # Start requester
-            self.requester.start(mode)
+            # Shut down a browser that can't be reused while the previous
+            # capture is still running, so its teardown traffic stays there
+            self.requester.retire(mode)
+            # Tor is kept running across consecutive tor work items, and is
+            # stopped before a normal capture starts so none of its traffic
+            # ends up there. Launching tor bootstraps over port 443, so the
+            # previous capture is stopped first to keep that traffic out of
+            # every pcap
+            if self.proxy.needs_launch(mode) and self.tcpdump.capturing:
+                self.tcpdump.stop()
+            self.proxy.set_mode(mode)
+            # Start packet capture. A capture left running by the previous
+            # work item is stopped in the same round trip
+            if self.tcpdump.capturing:
+                self.tcpdump.rotate(filename)
+            else:
+                self.tcpdump.start(filename)
+            # Start requester, reusing the running browser if possible
+            self.requester.ensure_started(mode)
 
             # Perform request in requester
             self.logger.info(
                 "Navigating to %s in %s mode (local: %d) (global: %d)", url,
                 mode, self.work_type_counts[mode], global_index)
             self.requester.request(url)
-
-            # End requester
-            self.requester.stop()
-            # End proxy
-            self.proxy.stop()
-            # End packet capture
-            self.tcpdump.stop()
+            # The capture is stopped when the next work item rotates it, or
+            # when the tcpdump daemon is shut down
         except TcpDumpError as err:
-            self.logger.error(str(err))
+            self.logger.error("%s", err)
             error = err
             fatal = True
         except Exception as err:
-            self.logger.error(str(err))
+            self.logger.error("%s", err)
             error = err
         # Store ending timestamp
-        finish_time = int(time.time() * 1e9)
+        finish_time = time_ns()
         # Create report
         report = {
             'success': error is None,
@@ -200,14 +322,22 @@ class Worker():
         return report
 
     def send_report(self, report: dict):
+        """
+        Queues a work report to be sent to the server in the background
+        :param report: report as created by perform_work
+        """
         # Stringify error
         if 'error' in report:
             report['error'] = str(report['error'])
+        self._executor.submit(self._send_report_raw, report)
+
+    def _send_report_raw(self, report: dict):
+        """
+        Sends a work report to the server
+        :param report: report as created by perform_work
+        """
         # Send the report
-        self.session.post("{}/work/report".format(self.work_url), json=report)
-        # FIXME: Make a dummy request to the server. to enforce the shutdown
-        # Allow this to fail
         try:
-            self.session.post("{}/status".format(self.work_url))
-        except:
-            pass
+            self.session.post(self._work_report_url, json=report)
+        except Exception as exc:
+            self.logger.error("Failed to send report: %s", exc)